@@ -2,16 +2,31 @@ import cv2
 import json
 import time
 import threading
+import multiprocessing
 import os
 import sys
-
-# import numpy as np
+import select
+import signal
+import numpy as np
+from multiprocessing import shared_memory
 import pygame
-from evdev import InputDevice, list_devices, ecodes
+from evdev import InputDevice, ecodes
+from doorbell_common import (
+    StaleFrameSkipper,
+    input_device_names,
+    open_capture,
+    pin_thread,
+)
 
 # --- RTSP OPTIMIZATION ---
-# Set these BEFORE importing cv2 if possible, but definitely before VideoCapture
-os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
+# Set these BEFORE importing cv2 if possible, but definitely before VideoCapture.
+# TCP avoids corrupt frames; the rest stops FFmpeg holding frames in its
+# input, jitter and reorder buffers and keeps stream probing short
+os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = (
+    "rtsp_transport;tcp"
+    "|fflags;nobuffer|flags;low_delay|max_delay;0|reorder_queue_size;0"
+    "|probesize;32768|analyzeduration;500000"
+)
 
 # --- HARDWARE CONFIG ---
 FB_DEVICE = "/dev/fb0"
@@ -24,11 +39,150 @@ AUTO_CYCLE_SECONDS = 1800
 TARGET_FPS = 12
 FRAME_TIME = 1.0 / TARGET_FPS
 
+# --- SCHEDULING ---
+# Video gets two cores so OpenCV's resize/cvtColor pool has a thread on
+# each; the lighter render and touch threads share a third. Keep
+# RENDER_CORES out of VIDEO_CORES, and add isolcpus=2,3 to
+# /boot/cmdline.txt to keep other processes off the video cores entirely.
+VIDEO_CORES = {2, 3}
+RENDER_CORES = {1}
+TOUCH_CORES = {1}
+VIDEO_PRIORITY = 10  # SCHED_FIFO priority for decoding (needs root)
+
 # --- CALIBRATION ---
 X_RAW_MIN, X_RAW_MAX = 300, 3900
 Y_RAW_MIN, Y_RAW_MAX = 300, 3950
 
 
+class FrameDecoder:
+    """Decodes the current camera in a child process, clear of the renderer's GIL.
+
+    Frames are written at screen size into one half of a SharedMemory
+    segment while the renderer shows the other; ready_idx says which half
+    holds the newest frame.
+    """
+
+    def __init__(
+        self,
+        cameras,
+        size,
+        rgb565,
+        shm_name,
+        cam_idx,
+        ready_idx,
+        running,
+        need_frame,
+        frame_ready,
+    ):
+        self.cameras = cameras
+        self.w, self.h = size
+        self.rgb565 = rgb565
+        self.cam_idx = cam_idx  # Shared with the renderer and touch thread
+        self.ready_idx = ready_idx
+        self.running = running
+        self.need_frame = need_frame  # Set once the last frame is shown
+        self.frame_ready = frame_ready  # Set while a slot awaits a blit
+        self.stale = StaleFrameSkipper(FRAME_TIME)
+        self.small = None  # Will be allocated on first frame
+
+        # Decode destinations: BGR24, or RGB565 packed as 2 bytes per pixel
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        channels = 2 if rgb565 else 3
+        slot_bytes = self.w * self.h * 3
+        self.slots = [
+            np.ndarray(
+                (self.h, self.w, channels),
+                np.uint8,
+                buffer=self.shm.buf,
+                offset=i * slot_bytes,
+            )
+            for i in range(2)
+        ]
+
+    def write_slot(self, slot, img):
+        """Copy a decoded BGR frame straight into a shared-memory slot.
+
+        The renderer wraps slots as BGR surfaces, so only 16bpp screens
+        need a colour conversion here.
+        """
+        dst = self.slots[slot]
+        h, w = img.shape[:2]
+        if self.rgb565:
+            if (w, h) == (self.w, self.h):
+                cv2.cvtColor(img, cv2.COLOR_BGR2BGR565, dst=dst)
+                return
+            # Pack the SMALL frame (much faster), then scale into place
+            if self.small is None or self.small.shape[:2] != (h, w):
+                self.small = np.empty((h, w, 2), dtype=np.uint8)
+            cv2.cvtColor(img, cv2.COLOR_BGR2BGR565, dst=self.small)
+            img = self.small
+        if (w, h) == (self.w, self.h):
+            np.copyto(dst, img)
+        else:
+            cv2.resize(img, (self.w, self.h), dst=dst, interpolation=cv2.INTER_NEAREST)
+
+    def run(self):
+        print("Starting video decoder process...")
+        pin_thread(VIDEO_CORES, VIDEO_PRIORITY)
+        # OpenCV's resize/cvtColor pool inherits this affinity: one thread per
+        # video core splits work across them without oversubscribing one
+        cv2.setNumThreads(len(VIDEO_CORES))
+
+        while self.running.value:
+            cam = self.cameras[self.cam_idx.value]
+            print(f"Connecting to camera: {cam['name']} at {cam['url']}")
+
+            cap = open_capture(cam["url"], (self.w, self.h))
+
+            if not cap.isOpened():
+                print(f"Failed to open camera: {cam['name']}")
+                time.sleep(5)
+                continue
+
+            print(f"Streaming: {cam['name']}")
+            self.stale.reset()
+            raw = None  # CPU decodes land here, reused frame to frame
+
+            while self.running.value and self.cameras[self.cam_idx.value] == cam:
+                # 1. Grab the frame (cheap)
+                if not cap.grab():
+                    print(f"Lost connection to {cam['name']}, reconnecting...")
+                    break
+
+                # 2. Only decode and process if the renderer is ready;
+                # otherwise sleep until it asks, or keep grabbing meanwhile
+                if not self.need_frame.wait(timeout=FRAME_TIME):
+                    continue
+
+                # 3. Skip anything stale, then Retrieve/Decode (expensive)
+                if not self.stale.drain(cap):
+                    print(f"Lost connection to {cam['name']}, reconnecting...")
+                    break
+                ret, img = cap.retrieve(raw)
+                if not ret:
+                    break
+                raw = img  # OpenCV decodes into it again if the size still fits
+
+                # 4. Fill the half the renderer is not showing, then flip
+                slot = 1 - self.ready_idx.value
+                self.write_slot(slot, img)
+                self.ready_idx.value = slot
+                self.need_frame.clear()
+                self.frame_ready.set()
+
+            cap.release()
+            print(f"Released camera: {cam['name']}")
+            time.sleep(1)
+
+
+def run_decoder(*args):
+    """Entry point of the decoder process."""
+    try:
+        FrameDecoder(*args).run()
+    except KeyboardInterrupt:
+        pass  # Ctrl+C reaches the whole group; the renderer does the cleanup
+
+
 class RTSPViewer:
     def __init__(self):
         print("Initializing RTSP Viewer...")
@@ -41,6 +195,10 @@ class RTSPViewer:
         print(f"Display resolution: {self.w}x{self.h}")
 
         self.screen = pygame.display.set_mode((self.w, self.h), pygame.FULLSCREEN)
+        # 16bpp screens get RGB565 frames end-to-end instead of 24-bit RGB
+        self.rgb565 = (
+            self.screen.get_bitsize() == 16 and self.screen.get_masks()[0] == 0xF800
+        )
 
         # Immediate visual feedback (like test.py)
         self.screen.fill((0, 0, 255))  # Blue screen
@@ -55,20 +213,72 @@ class RTSPViewer:
             self.cameras = json.load(f)
 
         print(f"Loaded {len(self.cameras)} cameras")
-        self.current_idx = 0
-        self.frame = None
+        # Decoding runs in its own process; spawn rather than fork, as SDL
+        # already has threads of its own running in this one
+        self.mp = multiprocessing.get_context("spawn")
+        self.cam_idx = self.mp.Value("i", 0, lock=False)  # See current_idx
+        self.ready_idx = self.mp.Value("i", 0, lock=False)  # Newest frame slot
+        self.decoding = self.mp.Value("b", 1, lock=False)
+        self.frame_ready = self.mp.Event()  # Set while a slot awaits a blit
+        self.need_frame = self.mp.Event()  # Set once the last frame is shown
+        self.need_frame.set()
         self.running = True
         self.btn_width = 80
-        self.last_interaction_time = time.time()
+        # Touch zones of the prev/next buttons, fixed for the session
+        self.left_xmax = self.btn_width
+        self.right_xmin = self.w - self.btn_width
+        # Touch calibration as a precomputed scale + offset per axis
+        self.touch_sx = self.w / (Y_RAW_MAX - Y_RAW_MIN)
+        self.touch_bx = -Y_RAW_MIN * self.touch_sx
+        self.touch_sy = self.h / (X_RAW_MAX - X_RAW_MIN)
+        self.touch_by = -X_RAW_MIN * self.touch_sy
+        self.next_cycle_at = time.monotonic() + AUTO_CYCLE_SECONDS
 
         # --- OPTIMIZATION: Pre-render UI ---
         self.ui_font = pygame.font.SysFont(None, 40)
         self.camera_surfaces = {}  # Cache for camera name surfaces
         self.last_rendered_idx = -1
+        self.name_rect = None  # Where the current camera name was last drawn
+        self.frame_rects = [pygame.Rect(0, 0, self.w, self.h)]
         self.nav_surfaces = self._create_nav_surfaces()
 
+        # Two screen-sized frame slots the decoder fills in turn (ping/pong).
+        # BGR slots are wrapped as surfaces once, so showing one is a single
+        # blit (SDL swaps the channels); RGB565 slots are copied into a
+        # surface in the screen's format.
+        slot_bytes = self.w * self.h * 3
+        self.shm = shared_memory.SharedMemory(create=True, size=2 * slot_bytes)
+        if self.rgb565:
+            self.slot_pixels = [
+                np.ndarray(
+                    (self.h, self.w),
+                    np.uint16,
+                    buffer=self.shm.buf,
+                    offset=i * slot_bytes,
+                )
+                for i in range(2)
+            ]
+            self.frame_surf = pygame.Surface((self.w, self.h), 0, self.screen)
+        else:
+            self.slot_surfs = [
+                pygame.image.frombuffer(
+                    self.shm.buf[i * slot_bytes : (i + 1) * slot_bytes],
+                    (self.w, self.h),
+                    "BGR",
+                )
+                for i in range(2)
+            ]
+
         print("RTSP Viewer initialized successfully")
 
+    @property
+    def current_idx(self):
+        return self.cam_idx.value
+
+    @current_idx.setter
+    def current_idx(self, idx):
+        self.cam_idx.value = idx
+
     def _create_nav_surfaces(self):
         """Pre-render navigation triangles as pygame surfaces."""
         surfaces = {}
@@ -109,152 +319,169 @@ class RTSPViewer:
             self.camera_surfaces[name] = (surf, (x, 20))
         return self.camera_surfaces[name]
 
+    def _draw_camera_name(self):
+        """Blit the current camera's name and return the rect it covers."""
+        self.last_rendered_idx = self.current_idx
+        cam_name = self.cameras[self.last_rendered_idx]["name"]
+        name_surf, name_pos = self._get_camera_name_surface(cam_name)
+        self.name_rect = self.screen.blit(name_surf, name_pos)
+        return self.name_rect
+
     def find_touch_device(self):
         print("Scanning for touch devices...")
         devices = []
         try:
-            devices = [InputDevice(path) for path in list_devices()]
+            devices = list(input_device_names())
         except:
             print("Error scanning input devices")
 
         print(f"Found {len(devices)} input devices")
-        for dev in devices:
+        for path, name in devices:
             if (
-                "WaveShare" in dev.name
-                or "ADS7846" in dev.name
-                or "Touchscreen" in dev.name
-                or "waveshare" in dev.name.lower()
+                "WaveShare" in name
+                or "ADS7846" in name
+                or "Touchscreen" in name
+                or "waveshare" in name.lower()
             ):
-                print(f"Using touch device: {dev.name} at {dev.path}")
-                return dev.path
+                print(f"Using touch device: {name} at {path}")
+                return path
         return None
 
     def map_coordinates(self, rx, ry):
-        try:
-            new_x_raw = ry
-            new_y_raw = rx
-            tx = (new_x_raw - Y_RAW_MIN) * self.w // (Y_RAW_MAX - Y_RAW_MIN)
-            ty = (new_y_raw - X_RAW_MIN) * self.h // (X_RAW_MAX - X_RAW_MIN)
-            tx = self.w - tx
-            return max(0, min(self.w - 1, tx)), max(0, min(self.h - 1, ty))
-        except:
-            return 0, 0
-
-    def video_worker(self):
-        print("Starting video worker thread...")
-
-        while self.running:
-            cam = self.cameras[self.current_idx]
-            print(f"Connecting to camera: {cam['name']} at {cam['url']}")
-
-            # Add a timeout to VideoCapture if possible (not directly supported, but we can try)
-            cap = cv2.VideoCapture(cam["url"], cv2.CAP_FFMPEG)
-            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Minimal buffer for low latency
-
-            if not cap.isOpened():
-                print(f"Failed to open camera: {cam['name']}")
-                time.sleep(5)
-                continue
-
-            print(f"Streaming: {cam['name']}")
-
-            while self.running and self.cameras[self.current_idx] == cam:
-                # 1. Grab the frame (cheap)
-                if not cap.grab():
-                    print(f"Lost connection to {cam['name']}, reconnecting...")
-                    break
-
-                # 2. Only decode and process if the main thread is ready
-                if self.frame is not None:
-                    time.sleep(0.005)  # Tiny sleep to yield
-                    continue
-
-                # 3. Retrieve/Decode (expensive)
-                ret, img = cap.retrieve()
-                if not ret:
-                    break
-
-                # 4. Color convert SMALL frame (much faster)
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-                # 5. Resize SMALL RGB to screen size (only if needed)
-                if (img_rgb.shape[1], img_rgb.shape[0]) != (self.w, self.h):
-                    img_rgb = cv2.resize(
-                        img_rgb, (self.w, self.h), interpolation=cv2.INTER_NEAREST
-                    )
-
-                # 6. Create surface from buffer without copying
-                self.frame = pygame.image.frombuffer(img_rgb, (self.w, self.h), "RGB")
-
-            cap.release()
-            print(f"Released camera: {cam['name']}")
-            time.sleep(1)
+        # Panel axes are swapped: raw Y drives screen X (mirrored), raw X drives Y
+        tx = self.w - int(ry * self.touch_sx + self.touch_bx)
+        ty = int(rx * self.touch_sy + self.touch_by)
+        return max(0, min(self.w - 1, tx)), max(0, min(self.h - 1, ty))
 
     def touch_worker(self):
+        pin_thread(TOUCH_CORES)
         dev_path = self.find_touch_device()
         if not dev_path:
             return
         try:
             touch_hw = InputDevice(dev_path)
+            try:
+                touch_hw.grab()  # Sole reader; keeps taps from reaching the console
+            except OSError:
+                pass
+            # Block in the kernel until the controller fires, then drain in one go
+            poller = select.epoll()
+            poller.register(touch_hw.fd, select.EPOLLIN)
             raw_x, raw_y = 0, 0
-            for event in touch_hw.read_loop():
-                if event.type == ecodes.EV_ABS:
-                    if event.code == ecodes.ABS_X:
-                        raw_x = event.value
-                    if event.code == ecodes.ABS_Y:
-                        raw_y = event.value
-                elif event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
-                    if event.value == 0:
-                        px, py = self.map_coordinates(raw_x, raw_y)
-                        if px < self.btn_width:
-                            self.current_idx = (self.current_idx - 1) % len(
-                                self.cameras
-                            )
-                        elif px > (self.w - self.btn_width):
-                            self.current_idx = (self.current_idx + 1) % len(
-                                self.cameras
-                            )
-                        self.last_interaction_time = time.time()
+            released = False
+            while self.running:
+                poller.poll()
+                for event in touch_hw.read():
+                    if event.type == ecodes.EV_ABS:
+                        if event.code == ecodes.ABS_X:
+                            raw_x = event.value
+                        if event.code == ecodes.ABS_Y:
+                            raw_y = event.value
+                    elif event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
+                        if event.value == 0:
+                            released = True
+                    elif (
+                        event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT
+                    ):
+                        # Act on a release only once its report is complete, so the
+                        # coordinates sent alongside it are already in
+                        if released:
+                            released = False
+                            px, py = self.map_coordinates(raw_x, raw_y)
+                            if px < self.left_xmax:
+                                self.current_idx = (self.current_idx - 1) % len(
+                                    self.cameras
+                                )
+                            elif px > self.right_xmin:
+                                self.current_idx = (self.current_idx + 1) % len(
+                                    self.cameras
+                                )
+                            self.next_cycle_at = time.monotonic() + AUTO_CYCLE_SECONDS
         except:
             pass
 
     def start(self):
-        threading.Thread(target=self.video_worker, daemon=True).start()
+        # systemd stops the service with SIGTERM; raise SystemExit on it so
+        # the cleanup below still runs and blanks the screen
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.decoder = self.mp.Process(
+            target=run_decoder,
+            args=(
+                self.cameras,
+                (self.w, self.h),
+                self.rgb565,
+                self.shm.name,
+                self.cam_idx,
+                self.ready_idx,
+                self.decoding,
+                self.need_frame,
+                self.frame_ready,
+            ),
+            daemon=True,
+        )
+        self.decoder.start()
         threading.Thread(target=self.touch_worker, daemon=True).start()
+        pin_thread(RENDER_CORES)
 
         try:
             while self.running:
-                start_loop = time.time()
+                now = time.monotonic()
 
                 # Auto-cycle check
-                if time.time() - self.last_interaction_time > AUTO_CYCLE_SECONDS:
+                if now >= self.next_cycle_at:
                     self.current_idx = (self.current_idx + 1) % len(self.cameras)
-                    self.last_interaction_time = time.time()
-
-                if self.frame is not None:
-                    self.screen.blit(self.frame, (0, 0))
-                    self.frame = None  # Signal ready for next frame
+                    self.next_cycle_at = now + AUTO_CYCLE_SECONDS
+
+                # Sleep until the decoder publishes a frame; the timeout keeps
+                # auto-cycle and relabelling going while a stream is stalled
+                if self.frame_ready.wait(timeout=FRAME_TIME):
+                    slot = self.ready_idx.value
+                    if self.rgb565:
+                        # Already packed by cvtColor in the decoder. pixels2d is
+                        # an (x, y) view of row-major memory, so copying the
+                        # transposed slot is a plain memcpy, not a strided walk
+                        pixels = pygame.surfarray.pixels2d(self.frame_surf)  # (x, y)
+                        np.copyto(pixels, self.slot_pixels[slot].T)
+                        del pixels  # Unlock the surface so it can be blitted
+                        self.screen.blit(self.frame_surf, (0, 0))
+                    else:
+                        self.screen.blit(self.slot_surfs[slot], (0, 0))
+                    self.frame_ready.clear()
+                    # The slot is on screen now; let the decoder fill the other
+                    self.need_frame.set()
 
                     # --- OPTIMIZED UI BLIT ---
                     # 1. Draw Name
-                    cam_name = self.cameras[self.current_idx]["name"]
-                    name_surf, name_pos = self._get_camera_name_surface(cam_name)
-                    self.screen.blit(name_surf, name_pos)
+                    self._draw_camera_name()
 
                     # 2. Draw Nav
                     for surf, pos in self.nav_surfaces.values():
                         self.screen.blit(surf, pos)
 
-                    pygame.display.flip()
-
-                # FPS Governor: sleep just enough to maintain TARGET_FPS
-                loop_time = time.time() - start_loop
-                time.sleep(max(0, FRAME_TIME - loop_time))
+                    pygame.display.update(self.frame_rects)
+
+                    # FPS Governor: never show frames faster than TARGET_FPS
+                    loop_time = time.monotonic() - now
+                    time.sleep(max(0, FRAME_TIME - loop_time))
+                elif (
+                    self.last_rendered_idx >= 0
+                    and self.last_rendered_idx != self.current_idx
+                ):
+                    # Switched camera but its stream isn't up yet: relabel the
+                    # frozen frame and push only the label rects
+                    old_rect = self.name_rect
+                    self.screen.fill((0, 0, 0), old_rect)
+                    pygame.display.update([old_rect, self._draw_camera_name()])
 
         except (KeyboardInterrupt, SystemExit):
             self.running = False
         finally:
             print("Cleaning up...")
+            self.decoding.value = 0
+            self.decoder.join(timeout=2)
+            self.slot_pixels = self.slot_surfs = None  # Release shm.buf
+            self.shm.close()
+            self.shm.unlink()
             try:
                 self.screen.fill((0, 0, 0))
                 pygame.display.flip()
@@ -4,20 +4,54 @@ import time
 import threading
 import os
 import sys
+import select
+import signal
 import numpy as np
 import mmap
 import subprocess
 import fcntl
 from PIL import Image, ImageDraw, ImageFont
-from evdev import InputDevice, list_devices, ecodes
+from evdev import InputDevice, ecodes
+from doorbell_common import (
+    OPEN_TIMEOUT_MS,
+    HWCapture,
+    StaleFrameSkipper,
+    get_fb_geometry,
+    input_device_names,
+    open_capture,
+    pin_thread,
+)
 
 # --- RTSP OPTIMIZATION ---
-os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
+# TCP avoids corrupt frames; the rest stops FFmpeg holding frames in its
+# input, jitter and reorder buffers and keeps stream probing short
+os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = (
+    "rtsp_transport;tcp"
+    "|fflags;nobuffer|flags;low_delay|max_delay;0|reorder_queue_size;0"
+    "|probesize;32768|analyzeduration;500000"
+)
 
 CONFIG_FILE = "feeds.json"
 AUTO_CYCLE_SECONDS = 1800
 TARGET_FPS = 12
 FRAME_TIME = 1.0 / TARGET_FPS
+FB_FALLBACK_MODE = (1280, 720, 32)  # If neither the driver nor sysfs can say
+
+# --- OPENCL ---
+# OpenCV builds with the T-API run cvtColor/resize on the GPU through UMat;
+# everywhere else frames stay plain NumPy arrays on the CPU.
+USE_OPENCL = cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OPENCL)
+
+# --- SCHEDULING ---
+# Video gets two cores so OpenCV's resize/cvtColor pool has a thread on
+# each; the lighter render and touch threads share a third. Keep
+# RENDER_CORES out of VIDEO_CORES, and add isolcpus=2,3 to
+# /boot/cmdline.txt to keep other processes off the video cores entirely.
+VIDEO_CORES = {2, 3}
+RENDER_CORES = {1}
+TOUCH_CORES = {1}
+VIDEO_PRIORITY = 10  # SCHED_FIFO priority for decoding (needs root)
 
 # --- CALIBRATION ---
 X_RAW_MIN, X_RAW_MAX = 300, 3900
@@ -114,14 +148,35 @@ class RTSPViewer:
         try:
             fb = open(fb_path, "r+b")
 
-            # We assume standard 1080p or 720p. For Pi, usually it's fixed at boot.
-            # We'll try to get resolution from sysfs if possible, or fallback to common.
-            self.w, self.h = self._get_fb_res()
-            self.bpp = self._get_fb_bpp()
-            print(f"Detected Framebuffer: {self.w}x{self.h} @ {self.bpp}bpp")
+            # Ask the driver for geometry; rows may be padded past w * bpp.
+            self.w, self.h, self.bpp, self.stride, self.red_first = get_fb_geometry(
+                fb, FB_FALLBACK_MODE
+            )
+            print(
+                f"Detected Framebuffer: {self.w}x{self.h} @ {self.bpp}bpp"
+                f" (stride {self.stride})"
+            )
 
-            fb_size = self.w * self.h * (self.bpp // 8)
-            self.fb_map = mmap.mmap(fb.fileno(), fb_size)
+            fb_size = self.stride * self.h
+            # Pre-fault every page up front (MAP_POPULATE, Python 3.10+) so
+            # the first frames don't take a page fault per 4 KB written
+            flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+            self.fb_map = mmap.mmap(fb.fileno(), fb_size, flags=flags)
+            try:
+                # We only ever stream through it front to back
+                self.fb_map.madvise(mmap.MADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                pass
+
+            # NumPy view of the visible pixels, so the worker's last pass
+            # (a copy, or the RGB565 pack) writes straight into the mmap
+            bypp = self.bpp // 8
+            self.fb_view = np.ndarray(
+                (self.h, self.w, bypp),
+                np.uint8,
+                self.fb_map,
+                strides=(self.stride, bypp, 1),
+            )
         except Exception as e:
             print(f"Error accessing framebuffer: {e}")
             sys.exit(1)
@@ -132,10 +187,20 @@ class RTSPViewer:
 
         print(f"Loaded {len(self.cameras)} cameras")
         self.current_idx = 0
-        self.frame = None
+        self.need_frame = threading.Event()  # Set by the main loop at TARGET_FPS
+        self.need_frame.set()
+        self.stale = StaleFrameSkipper(FRAME_TIME)
         self.running = True
         self.btn_width = 80
-        self.last_interaction_time = time.time()
+        # Touch zones of the prev/next buttons, fixed for the session
+        self.left_xmax = self.btn_width
+        self.right_xmin = self.w - self.btn_width
+        # Touch calibration as a precomputed scale + offset per axis
+        self.touch_sx = self.w / (Y_RAW_MAX - Y_RAW_MIN)
+        self.touch_bx = -Y_RAW_MIN * self.touch_sx
+        self.touch_sy = self.h / (X_RAW_MAX - X_RAW_MIN)
+        self.touch_by = -X_RAW_MIN * self.touch_sy
+        self.next_cycle_at = time.monotonic() + AUTO_CYCLE_SECONDS
 
         # --- UI Assets ---
         try:
@@ -144,40 +209,156 @@ class RTSPViewer:
             )
         except:
             self.font = ImageFont.load_default()
-
-        self.ui_overlay = None
-        self.ui_regions = []  # List of (y1, y2, x1, x2, overlay_rgb, mask)
-
-        # Pre-allocate buffers to avoid per-frame allocation
-        self.out_buffer = np.zeros(
-            (self.h, self.w, 4 if self.bpp == 32 else 3), dtype=np.uint8
-        )
-        self.full_rgb = np.zeros((self.h, self.w, 3), dtype=np.uint8)
-        self.small_rgb = None  # Will be allocated on first frame
-
-        self._update_ui_assets()
+        self.glyphs = self._build_glyph_atlas()
+
+        self.ui_regions = []  # List of region dicts, see _sprite_regions
+
+        # Pre-allocate buffers to avoid per-frame allocation. Frames are built
+        # in OpenCV's BGR order, as 4-channel BGRA (XRGB8888) at 32bpp so they
+        # go out without another conversion; the UI is stored to match.
+        if self.bpp == 32:
+            self.canvas = np.zeros((self.h, self.w, 4), dtype=np.uint8)
+            self.canvas_code = cv2.COLOR_BGR2BGRA
+            self.yuv_code = cv2.COLOR_YUV2BGRA_I420
+        else:
+            self.canvas = np.zeros((self.h, self.w, 3), dtype=np.uint8)
+            self.canvas_code = None  # Decoded frames are BGR already
+            self.yuv_code = cv2.COLOR_YUV2BGR_I420
+        self.small = None  # Will be allocated on first frame
+
+        # bpp is fixed, so pick the framebuffer writer once instead of
+        # branching on it every frame. Writers take a band of rows.
+        canvas, fb_view = self.canvas, self.fb_view
+        if self.bpp == 16:
+            code = cv2.COLOR_RGB2BGR565 if self.red_first else cv2.COLOR_BGR2BGR565
+        elif self.red_first:
+            # RGB(X) byte order: swap R and B on the way out
+            code = cv2.COLOR_BGRA2RGBA if self.bpp == 32 else cv2.COLOR_BGR2RGB
+        else:
+            code = None  # BGR(X): the canvas is already in fb layout
+
+        if code is None:
+
+            def write_frame(y1, y2):
+                np.copyto(fb_view[y1:y2], canvas[y1:y2])
+
+        else:
+
+            def write_frame(y1, y2):
+                # One SIMD pass; for RGB565, per-channel NumPy LUT gathers
+                # give the same bytes ~40x slower
+                cv2.cvtColor(canvas[y1:y2], code, dst=fb_view[y1:y2])
+
+        self.write_frame = write_frame
+
+        # Last frame written out; rows that still match it are not written
+        # again. Rows are compared as 64-bit words where they divide evenly.
+        self.prev_canvas = np.zeros_like(self.canvas)
+        word = np.uint64 if self.canvas[0].nbytes % 8 == 0 else np.uint8
+        self.canvas_words = self.canvas.reshape(self.h, -1).view(word)
+        self.prev_words = self.prev_canvas.reshape(self.h, -1).view(word)
+        self.row_diff = np.empty(self.canvas_words.shape, dtype=bool)
+        self.full_redraw = True  # fb holds someone else's pixels at start
+
+        # Rasterize every camera's UI once instead of on each switch
+        self.nav_regions = self._build_nav_regions()
+        # Keyed by camera name, so cameras sharing a name share one raster
+        self.ui_assets = {
+            name: self._build_ui_regions(name)
+            for name in dict.fromkeys(cam["name"] for cam in self.cameras)
+        }
+        self.ui_regions = self.ui_assets[self.cameras[self.current_idx]["name"]]
 
         print("RTSP Viewer initialized successfully")
 
-    def _get_fb_res(self):
+    def _build_glyph_atlas(self):
+        """Rasterize each printable ASCII glyph once; names are composed from it."""
         try:
-            with open("/sys/class/graphics/fb0/virtual_size", "r") as f:
-                res = f.read().strip().split(",")
-                return int(res[0]), int(res[1])
-        except:
-            return 1280, 720
+            ascent, descent = self.font.getmetrics()
+            atlas = {}
+            for ch in map(chr, range(32, 127)):
+                advance = self.font.getlength(ch)
+                img = Image.new("L", (int(advance) + ascent, ascent + descent), 0)
+                ImageDraw.Draw(img).text((0, 0), ch, font=self.font, fill=255)
+                atlas[ch] = (np.array(img), advance)
+            return atlas
+        except AttributeError:
+            return None  # Old bitmap fonts lack metrics; render names directly
+
+    def _compose_text_mask(self, text):
+        """Alpha mask for text built from the glyph atlas, or None if unsupported."""
+        if not text or not self.glyphs or any(ch not in self.glyphs for ch in text):
+            return None
+        offsets, pen = [], 0.0
+        for ch in text:
+            offsets.append(int(round(pen)))
+            pen += self.glyphs[ch][1]
+        width = max(x + self.glyphs[ch][0].shape[1] for ch, x in zip(text, offsets))
+        mask = np.zeros((self.glyphs[text[0]][0].shape[0], width), dtype=np.uint8)
+        for ch, x in zip(text, offsets):
+            glyph = self.glyphs[ch][0]
+            roi = mask[:, x : x + glyph.shape[1]]
+            np.maximum(roi, glyph, out=roi)
+        # Trim the overhang slack so centering uses the inked width
+        inked = np.flatnonzero(mask.any(axis=0))
+        return mask[:, : inked[-1] + 1] if len(inked) else mask
+
+    def _sprite_regions(self, arr, x, y):
+        """Region list for an RGBA sprite placed at (x, y) on screen."""
+        # Crop to the pixels the sprite actually covers so the per-frame
+        # blend never touches its transparent padding
+        ys, xs = np.nonzero(arr[:, :, 3])
+        if len(ys) == 0:
+            return []
+        y0, x0 = ys.min(), xs.min()
+        arr = arr[y0 : ys.max() + 1, x0 : xs.max() + 1]
+        arr = arr[:, :, [2, 1, 0, 3]]  # Match the BGR(A) canvas
+        x, y = x + int(x0), y + int(y0)
+        # Everything but the frame's own term is fixed, so keep it in uint16
+        # ready for the per-frame blend
+        alpha = arr[:, :, 3:4].astype(np.uint16)
+        return [
+            {
+                "y1": y,
+                "y2": y + arr.shape[0],
+                "x1": x,
+                "x2": x + arr.shape[1],
+                "inv_alpha": 255 - alpha,
+                "overlay": arr[:, :, :3] * alpha + 128,  # overlay * alpha + round
+                "acc": np.empty(arr.shape[:2] + (3,), dtype=np.uint16),
+                "tmp": np.empty(arr.shape[:2] + (3,), dtype=np.uint16),
+                "where": alpha > 0,
+            }
+        ]
+
+    def _build_nav_regions(self):
+        """Rasterize the navigation triangles once; every camera shares them."""
+        regions = []
+        if len(self.cameras) <= 1:
+            return regions
+
+        size = 40
+        mid_y = self.h // 2
+        for side in ["left", "right"]:
+            img = Image.new("RGBA", (size + 4, size * 2 + 4), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(img)
+            pts = (
+                [(0, size), (size, 0), (size, size * 2)]
+                if side == "left"
+                else [(size, size), (0, 0), (0, size * 2)]
+            )
+            draw.polygon(pts, fill=(200, 200, 200, 180))
 
-    def _get_fb_bpp(self):
-        try:
-            with open("/sys/class/graphics/fb0/bits_per_pixel", "r") as f:
-                return int(f.read().strip())
-        except:
-            return 32
+            x = 10 if side == "left" else self.w - size - 10
+            regions += self._sprite_regions(np.array(img), x, mid_y - size)
+        return regions
 
-    def _update_ui_assets(self):
-        """Pre-render UI elements and identify their regions for fast blitting."""
-        cam_name = self.cameras[self.current_idx]["name"]
-        self.ui_regions = []
+    def _build_ui_regions(self, cam_name):
+        """Pre-render a camera's UI elements and their regions for fast blitting."""
+        regions = []
+
+        def add_sprite(arr, x, y):
+            regions.extend(self._sprite_regions(arr, x, y))
 
         def add_region(text, font, color, pos_func):
             # Temporary image to get dimensions
@@ -198,186 +379,230 @@ class RTSPViewer:
             # Main text
             draw.text((0, 0), text, font=font, fill=color)
 
-            arr = np.array(img)
-            self.ui_regions.append(
-                {
-                    "y1": y,
-                    "y2": y + arr.shape[0],
-                    "x1": x,
-                    "x2": x + arr.shape[1],
-                    "rgb": arr[:, :, :3],
-                    "mask": arr[:, :, 3:4] / 255.0,
-                }
-            )
+            add_sprite(np.array(img), x, y)
 
         # 1. Camera Name (Centered)
-        add_region(
-            cam_name,
-            self.font,
-            (255, 255, 0, 255),
-            lambda tw, th: ((self.w - tw) // 2, 20),
-        )
-
-        # 2. Navigation Triangles
-        if len(self.cameras) > 1:
-            size = 40
-            mid_y = self.h // 2
-
-            for side in ["left", "right"]:
-                img = Image.new("RGBA", (size + 4, size * 2 + 4), (0, 0, 0, 0))
-                draw = ImageDraw.Draw(img)
-                pts = (
-                    [(0, size), (size, 0), (size, size * 2)]
-                    if side == "left"
-                    else [(size, size), (0, 0), (0, size * 2)]
-                )
-                draw.polygon(pts, fill=(200, 200, 200, 180))
-
-                arr = np.array(img)
-                x = 10 if side == "left" else self.w - size - 10
-                y = mid_y - size
-                self.ui_regions.append(
-                    {
-                        "y1": y,
-                        "y2": y + arr.shape[0],
-                        "x1": x,
-                        "x2": x + arr.shape[1],
-                        "rgb": arr[:, :, :3],
-                        "mask": arr[:, :, 3:4] / 255.0,
-                    }
-                )
+        mask = self._compose_text_mask(cam_name)
+        if mask is not None:
+            # Yellow text over a black drop shadow offset by (2, 2)
+            th, tw = mask.shape
+            text_a = np.zeros((th + 2, tw + 2), dtype=np.float32)
+            shadow_a = np.zeros_like(text_a)
+            text_a[:th, :tw] = mask / 255.0
+            shadow_a[2:, 2:] = mask / 255.0
+            alpha = text_a + shadow_a * (1.0 - text_a)
+            arr = np.zeros((th + 2, tw + 2, 4), dtype=np.uint8)
+            arr[:, :, :3] = (
+                np.array([255, 255, 0]) * (text_a / np.maximum(alpha, 1e-6))[..., None]
+            ).astype(np.uint8)
+            arr[:, :, 3] = (alpha * 255).astype(np.uint8)
+            add_sprite(arr, (self.w - tw) // 2, 20)
+        else:
+            add_region(
+                cam_name,
+                self.font,
+                (255, 255, 0, 255),
+                lambda tw, th: ((self.w - tw) // 2, 20),
+            )
+
+        # 2. Navigation Triangles (shared, rasterized once)
+        return regions + self.nav_regions
 
     def find_touch_device(self):
-        devices = [InputDevice(path) for path in list_devices()]
-        for dev in devices:
-            name = dev.name.lower()
+        for path, name in input_device_names():
+            name = name.lower()
             if any(k in name for k in ["waveshare", "ads7846", "touchscreen"]):
-                return dev.path
+                return path
         return None
 
     def map_coordinates(self, rx, ry):
-        try:
-            new_x_raw = ry
-            new_y_raw = rx
-            tx = (new_x_raw - Y_RAW_MIN) * self.w // (Y_RAW_MAX - Y_RAW_MIN)
-            ty = (new_y_raw - X_RAW_MIN) * self.h // (X_RAW_MAX - X_RAW_MIN)
-            tx = self.w - tx
-            return max(0, min(self.w - 1, tx)), max(0, min(self.h - 1, ty))
-        except:
-            return 0, 0
+        # Panel axes are swapped: raw Y drives screen X (mirrored), raw X drives Y
+        tx = self.w - int(ry * self.touch_sx + self.touch_bx)
+        ty = int(rx * self.touch_sy + self.touch_by)
+        return max(0, min(self.w - 1, tx)), max(0, min(self.h - 1, ty))
+
+    def flush_dirty_rows(self):
+        """Write only the canvas rows that changed since the last frame.
+
+        Static scenes leave most rows identical, which saves framebuffer
+        bandwidth (and SPI traffic on deferred-io panels).
+        """
+        if self.full_redraw:
+            self.full_redraw = False
+            self.write_frame(0, self.h)
+            np.copyto(self.prev_canvas, self.canvas)
+            return
+        np.not_equal(self.canvas_words, self.prev_words, out=self.row_diff)
+        dirty = self.row_diff.any(axis=1).view(np.int8)
+        # Starts and ends of each run of dirty rows, interleaved
+        edges = np.flatnonzero(np.diff(dirty, prepend=0, append=0))
+        for y1, y2 in zip(edges[::2], edges[1::2]):
+            self.write_frame(y1, y2)
+            np.copyto(self.prev_canvas[y1:y2], self.canvas[y1:y2])
 
     def video_worker(self):
+        pin_thread(VIDEO_CORES, VIDEO_PRIORITY)
+        # OpenCV's resize/cvtColor pool inherits this affinity: one thread per
+        # video core splits work across them without oversubscribing one
+        cv2.setNumThreads(len(VIDEO_CORES))
         while self.running:
             cam = self.cameras[self.current_idx]
-            cap = cv2.VideoCapture(cam["url"], cv2.CAP_FFMPEG)
-            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            # Raw I420 from the hardware decoder: half the pipe traffic of
+            # bgr24 and no swscale pass; we convert it once into the canvas
+            cap = open_capture(cam["url"], (self.w, self.h), "yuv420p")
 
             if not cap.isOpened():
                 time.sleep(5)
                 continue
 
-            self._update_ui_assets()
+            self.stale.reset()
+            raw = None  # CPU decodes land here, reused frame to frame
+            self.ui_regions = self.ui_assets[cam["name"]]
+            self.full_redraw = True
 
             while self.running and self.cameras[self.current_idx] == cam:
                 if not cap.grab():
                     break
-                if self.frame is not None:
-                    time.sleep(0.005)
+                if not self.need_frame.wait(timeout=FRAME_TIME):
                     continue
+                if not self.stale.drain(cap):
+                    break
 
-                ret, img = cap.retrieve()
+                ret, img = cap.retrieve(raw)
                 if not ret:
                     break
+                raw = img  # OpenCV decodes into it again if the size still fits
+                self.need_frame.clear()
 
                 # 1. Color convert small and Resize using pre-allocated buffers
-                if self.small_rgb is None or self.small_rgb.shape[:2] != img.shape[:2]:
-                    self.small_rgb = np.zeros(
-                        (img.shape[0], img.shape[1], 3), dtype=np.uint8
+                if isinstance(cap, HWCapture):
+                    # Screen-sized I420 from FFmpeg: one pass into the canvas.
+                    # Its frames are read-only, so this also gives us a
+                    # buffer to blend into.
+                    cv2.cvtColor(img, self.yuv_code, dst=self.canvas)
+                elif self.canvas_code is None:
+                    # BGR canvas: the frame goes in as is, scaled if needed
+                    if img.shape[:2] == self.canvas.shape[:2]:
+                        np.copyto(self.canvas, img)
+                    else:
+                        cv2.resize(
+                            img,
+                            (self.w, self.h),
+                            dst=self.canvas,
+                            interpolation=cv2.INTER_NEAREST,
+                        )
+                elif img.shape[:2] == self.canvas.shape[:2]:
+                    # Already screen-sized: convert straight into the canvas
+                    # and skip the 1:1 resize copy
+                    cv2.cvtColor(img, self.canvas_code, dst=self.canvas)
+                elif USE_OPENCL:
+                    # Upload once, convert and scale on the GPU, then
+                    # download into the buffer the UI is blended into
+                    um = cv2.cvtColor(cv2.UMat(img), self.canvas_code)
+                    um = cv2.resize(
+                        um, (self.w, self.h), interpolation=cv2.INTER_NEAREST
                     )
+                    np.copyto(self.canvas, um.get())
+                else:
+                    if self.small is None or self.small.shape[:2] != img.shape[:2]:
+                        self.small = np.zeros(
+                            img.shape[:2] + self.canvas.shape[2:], dtype=np.uint8
+                        )
 
-                cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self.small_rgb)
-                cv2.resize(
-                    self.small_rgb,
-                    (self.w, self.h),
-                    dst=self.full_rgb,
-                    interpolation=cv2.INTER_NEAREST,
-                )
+                    cv2.cvtColor(img, self.canvas_code, dst=self.small)
+                    cv2.resize(
+                        self.small,
+                        (self.w, self.h),
+                        dst=self.canvas,
+                        interpolation=cv2.INTER_NEAREST,
+                    )
 
                 # 2. Fast Targeted Blending of UI (Integer math)
                 for reg in self.ui_regions:
-                    roi = self.full_rgb[reg["y1"] : reg["y2"], reg["x1"] : reg["x2"]]
-                    # Integer blending: (src * (255-alpha) + overlay * alpha) >> 8
-                    # We use uint16 for intermediate to avoid overflow
-                    alpha = (reg["mask"] * 255).astype(np.uint16)
-                    blended = (
-                        (
-                            roi.astype(np.uint16) * (255 - alpha)
-                            + reg["rgb"].astype(np.uint16) * alpha
-                        )
-                        >> 8
-                    ).astype(np.uint8)
-                    self.full_rgb[reg["y1"] : reg["y2"], reg["x1"] : reg["x2"]] = (
-                        blended
-                    )
-
-                # 3. Handle different BPP efficiently
-                if self.bpp == 32:
-                    # RGB -> RGBA expansion
-                    cv2.cvtColor(self.full_rgb, cv2.COLOR_RGB2RGBA, dst=self.out_buffer)
-                    self.frame = self.out_buffer.tobytes()
-                elif self.bpp == 16:
-                    # RGB565 conversion
-                    r = (self.full_rgb[:, :, 0] >> 3).astype(np.uint16)
-                    g = (self.full_rgb[:, :, 1] >> 2).astype(np.uint16)
-                    b = (self.full_rgb[:, :, 2] >> 3).astype(np.uint16)
-                    self.frame = ((r << 11) | (g << 5) | b).astype(np.uint16).tobytes()
-                else:
-                    self.frame = self.full_rgb.tobytes()
+                    roi = self.canvas[reg["y1"] : reg["y2"], reg["x1"] : reg["x2"], :3]
+                    # Integer blending: (src * (255-alpha) + overlay * alpha) / 255,
+                    # rounded exactly as (x + (x >> 8)) >> 8 with x offset by 128.
+                    # Runs in the region's own uint16 scratch; nothing is allocated
+                    acc, tmp = reg["acc"], reg["tmp"]
+                    np.multiply(roi, reg["inv_alpha"], out=acc)
+                    np.add(acc, reg["overlay"], out=acc)
+                    np.right_shift(acc, 8, out=tmp)
+                    np.add(acc, tmp, out=acc)
+                    np.right_shift(acc, 8, out=acc)
+                    # Only write covered pixels; transparent ones stay untouched
+                    np.copyto(roi, acc, casting="unsafe", where=reg["where"])
+
+                # 3. Write the finished frame straight into the framebuffer
+                self.flush_dirty_rows()
 
             cap.release()
             time.sleep(1)
 
     def touch_worker(self):
+        pin_thread(TOUCH_CORES)
         dev_path = self.find_touch_device()
         if not dev_path:
             return
         touch_hw = InputDevice(dev_path)
+        try:
+            touch_hw.grab()  # Sole reader; keeps taps from reaching the console
+        except OSError:
+            pass
+        # Block in the kernel until the controller fires, then drain in one go
+        poller = select.epoll()
+        poller.register(touch_hw.fd, select.EPOLLIN)
         raw_x, raw_y = 0, 0
-        for event in touch_hw.read_loop():
-            if event.type == ecodes.EV_ABS:
-                if event.code == ecodes.ABS_X:
-                    raw_x = event.value
-                if event.code == ecodes.ABS_Y:
-                    raw_y = event.value
-            elif event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
-                if event.value == 0:
-                    px, py = self.map_coordinates(raw_x, raw_y)
-                    if px < self.btn_width:
-                        self.current_idx = (self.current_idx - 1) % len(self.cameras)
-                    elif px > (self.w - self.btn_width):
-                        self.current_idx = (self.current_idx + 1) % len(self.cameras)
-                    self.last_interaction_time = time.time()
+        released = False
+        while self.running:
+            poller.poll()
+            for event in touch_hw.read():
+                if event.type == ecodes.EV_ABS:
+                    if event.code == ecodes.ABS_X:
+                        raw_x = event.value
+                    if event.code == ecodes.ABS_Y:
+                        raw_y = event.value
+                elif event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
+                    if event.value == 0:
+                        released = True
+                elif event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT:
+                    # Act on a release only once its report is complete, so the
+                    # coordinates sent alongside it are already in
+                    if released:
+                        released = False
+                        px, py = self.map_coordinates(raw_x, raw_y)
+                        if px < self.left_xmax:
+                            self.current_idx = (self.current_idx - 1) % len(
+                                self.cameras
+                            )
+                        elif px > self.right_xmin:
+                            self.current_idx = (self.current_idx + 1) % len(
+                                self.cameras
+                            )
+                        self.next_cycle_at = time.monotonic() + AUTO_CYCLE_SECONDS
 
     def start(self):
-        threading.Thread(target=self.video_worker, daemon=True).start()
+        # systemd stops the service with SIGTERM; raise SystemExit on it so
+        # the cleanup below still runs and blanks the screen
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.video_thread = threading.Thread(target=self.video_worker, daemon=True)
+        self.video_thread.start()
         threading.Thread(target=self.touch_worker, daemon=True).start()
+        pin_thread(RENDER_CORES)
 
         # Final attempt to hide cursor before loop
         self._set_cursor(False)
 
         try:
             while self.running:
-                start_loop = time.time()
-                if time.time() - self.last_interaction_time > AUTO_CYCLE_SECONDS:
+                now = time.monotonic()
+                if now >= self.next_cycle_at:
                     self.current_idx = (self.current_idx + 1) % len(self.cameras)
-                    self.last_interaction_time = time.time()
+                    self.next_cycle_at = now + AUTO_CYCLE_SECONDS
 
-                if self.frame is not None:
-                    self.fb_map.seek(0)
-                    self.fb_map.write(self.frame)
-                    self.frame = None
+                # Let the worker put up the next frame
+                self.need_frame.set()
 
-                time.sleep(max(0, FRAME_TIME - (time.time() - start_loop)))
+                time.sleep(max(0, FRAME_TIME - (time.monotonic() - now)))
         except Exception as e:
             print(f"Main loop error: {e}")
             import traceback
@@ -385,11 +610,19 @@ class RTSPViewer:
             traceback.print_exc()
             self.running = False
         finally:
+            self.running = False
+            # Let the worker finish its frame first: fb_view holds no buffer
+            # export, so closing the map under it would crash, not raise.
+            # A blocked grab gives up after OPEN_TIMEOUT_MS.
+            self.need_frame.clear()
+            self.video_thread.join(timeout=OPEN_TIMEOUT_MS / 1000 + 1)
             # Restore terminal cursor
             self._set_cursor(True)
             if hasattr(self, "fb_map"):
                 try:
-                    self.fb_map.close()
+                    self.fb_view[:] = 0  # Blank the screen in place
+                    if not self.video_thread.is_alive():
+                        self.fb_map.close()
                 except:
                     pass
             # Use os._exit to prevent "terminate called" errors from background threads
@@ -4,18 +4,39 @@ import time
 import threading
 import os
 import sys
+import select
+import signal
+import mmap
 import numpy as np  # Required for high-performance drawing
-from luma.core.device import linux_framebuffer
-from PIL import Image
-from evdev import InputDevice, list_devices, ecodes
+from evdev import InputDevice, ecodes
+from doorbell_common import (
+    OPEN_TIMEOUT_MS,
+    HWCapture,
+    StaleFrameSkipper,
+    get_fb_geometry,
+    input_device_names,
+    open_capture,
+    pin_thread,
+)
 
 # --- HARDWARE CONFIG ---
 FB_DEVICE = "/dev/fb1"
+FB_FALLBACK_MODE = (480, 320, 16)  # Waveshare 3.5" SPI panel, if sysfs fails too
 CONFIG_FILE = "feeds.json"
 AUTO_CYCLE_SECONDS = 1800
 TARGET_FPS = 12  # Reducing FPS is the best way to save CPU on Pi Zero 2W
 FRAME_TIME = 1.0 / TARGET_FPS
 
+# --- SCHEDULING ---
+# Video gets two cores so OpenCV's resize/cvtColor pool has a thread on
+# each; the lighter render and touch threads share a third. Keep
+# RENDER_CORES out of VIDEO_CORES, and add isolcpus=2,3 to
+# /boot/cmdline.txt to keep other processes off the video cores entirely.
+VIDEO_CORES = {2, 3}
+RENDER_CORES = {1}
+TOUCH_CORES = {1}
+VIDEO_PRIORITY = 10  # SCHED_FIFO priority for decoding (needs root)
+
 # --- CALIBRATION ---
 X_RAW_MIN, X_RAW_MAX = 300, 3900
 Y_RAW_MIN, Y_RAW_MAX = 300, 3950
@@ -23,150 +44,313 @@ Y_RAW_MIN, Y_RAW_MAX = 300, 3950
 
 class RTSPViewer:
     def __init__(self):
-        self.device = linux_framebuffer(FB_DEVICE)
-        self.w, self.h = self.device.width, self.device.height
+        # Map the panel's framebuffer and write frames into it ourselves;
+        # no PIL image or per-frame bytes() copy on the way out
+        with open(FB_DEVICE, "r+b") as fb:
+            self.w, self.h, self.bpp, self.stride, self.red_first = get_fb_geometry(
+                fb, FB_FALLBACK_MODE
+            )
+            fb_size = self.stride * self.h
+            # Pre-fault every page up front (MAP_POPULATE, Python 3.10+)
+            flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+            self.fb_map = mmap.mmap(fb.fileno(), fb_size, flags=flags)
+        bypp = self.bpp // 8
+        self.fb_view = np.ndarray(
+            (self.h, self.w, bypp),
+            np.uint8,
+            self.fb_map,
+            strides=(self.stride, bypp, 1),
+        )
+        print(f"Framebuffer {FB_DEVICE}: {self.w}x{self.h} @ {self.bpp}bpp")
 
         with open(CONFIG_FILE, "r") as f:
             self.cameras = json.load(f)
 
         self.current_idx = 0
-        self.frame = None
+        self.stale = StaleFrameSkipper(FRAME_TIME)
+        self.need_frame = threading.Event()  # Set by the main loop at TARGET_FPS
+        self.need_frame.set()
         self.running = True
         self.btn_width = 80
-        self.last_interaction_time = time.time()
+        # Touch zones of the prev/next buttons, fixed for the session
+        self.left_xmax = self.btn_width
+        self.right_xmin = self.w - self.btn_width
+        # Touch calibration as a precomputed scale + offset per axis
+        self.touch_sx = self.w / (Y_RAW_MAX - Y_RAW_MIN)
+        self.touch_bx = -Y_RAW_MIN * self.touch_sx
+        self.touch_sy = self.h / (X_RAW_MAX - X_RAW_MIN)
+        self.touch_by = -X_RAW_MIN * self.touch_sy
+        self.next_cycle_at = time.monotonic() + AUTO_CYCLE_SECONDS
+
+        # Pre-allocate buffers to avoid per-frame allocation
+        self.full_bgr = np.empty((self.h, self.w, 3), dtype=np.uint8)
+        # One conversion from the BGR frame into the panel's pixel format
+        if self.bpp == 16:
+            self.fb_code = (
+                cv2.COLOR_RGB2BGR565 if self.red_first else cv2.COLOR_BGR2BGR565
+            )
+        elif self.bpp == 32:
+            self.fb_code = cv2.COLOR_BGR2RGBA if self.red_first else cv2.COLOR_BGR2BGRA
+        else:
+            # BGR888 is a plain copy; only RGB888 needs the swap
+            self.fb_code = cv2.COLOR_BGR2RGB if self.red_first else None
+
+        # Rasterize the UI once; frames only blend these small regions
+        self.nav_regions = self._build_nav_regions()
+        # Keyed by camera name, so cameras sharing a name share one raster
+        self.ui_assets = {
+            name: self._build_ui_regions(name)
+            for name in dict.fromkeys(cam["name"] for cam in self.cameras)
+        }
+
+    def _ui_regions(self, color, draw):
+        """Rasterize one UI element via draw(img, color) into blend regions.
+
+        The element is drawn once as an alpha mask and cropped to what it
+        covers, so the per-frame blend only touches those pixels.
+        """
+        alpha = np.zeros((self.h, self.w), dtype=np.uint8)
+        draw(alpha, 255)
+        ys, xs = np.nonzero(alpha)
+        if len(ys) == 0:
+            return []
+        y1, y2 = int(ys.min()), int(ys.max()) + 1
+        x1, x2 = int(xs.min()), int(xs.max()) + 1
+        a = alpha[y1:y2, x1:x2, None].astype(np.uint16)
+        return [
+            {
+                "y1": y1,
+                "y2": y2,
+                "x1": x1,
+                "x2": x2,
+                "inv_alpha": 255 - a,
+                # overlay * alpha + 128 to round; colors are RGB, frames BGR
+                "overlay": np.array(color[::-1], dtype=np.uint16) * a + 128,
+                "acc": np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint16),
+                "tmp": np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint16),
+                "where": a > 0,
+            }
+        ]
+
+    def _build_nav_regions(self):
+        """Left/right arrows, shared by every camera (RGB colors)."""
+        pts_l = np.array(
+            [[10, self.h // 2], [30, self.h // 2 - 20], [30, self.h // 2 + 20]],
+            np.int32,
+        )
+        pts_r = np.array(
+            [
+                [self.w - 10, self.h // 2],
+                [self.w - 30, self.h // 2 - 20],
+                [self.w - 30, self.h // 2 + 20],
+            ],
+            np.int32,
+        )
+        regions = []
+        for pts in (pts_l, pts_r):
+            regions += self._ui_regions(
+                (255, 255, 255), lambda img, c: cv2.fillPoly(img, [pts], c)
+            )
+        return regions
+
+    def _build_ui_regions(self, cam_name):
+        """A camera's label plus the shared arrows."""
+
+        def draw_label(img, color):
+            # Top Label (Black box + Text)
+            # cv2.rectangle(img, (self.w//2 - 60, 5), (self.w//2 + 60, 30), (0, 0, 0), -1)
+            cv2.putText(
+                img,
+                cam_name,
+                (self.w // 2 - 45, 22),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                color,
+                1,
+                cv2.LINE_AA,
+            )
+
+        return self._ui_regions((255, 255, 0), draw_label) + self.nav_regions
 
     def find_touch_device(self):
-        devices = [InputDevice(path) for path in list_devices()]
-        for dev in devices:
-            if "ADS7846" in dev.name or "Touchscreen" in dev.name:
-                return dev.path
+        for path, name in input_device_names():
+            if "ADS7846" in name or "Touchscreen" in name:
+                return path
         return None
 
     def map_coordinates(self, rx, ry):
-        try:
-            new_x_raw = ry
-            new_y_raw = rx
-            tx = (new_x_raw - Y_RAW_MIN) * self.w // (Y_RAW_MAX - Y_RAW_MIN)
-            ty = (new_y_raw - X_RAW_MIN) * self.h // (X_RAW_MAX - X_RAW_MIN)
-            tx = self.w - tx
-            return max(0, min(self.w - 1, tx)), max(0, min(self.h - 1, ty))
-        except:
-            return 0, 0
+        # Panel axes are swapped: raw Y drives screen X (mirrored), raw X drives Y
+        tx = self.w - int(ry * self.touch_sx + self.touch_bx)
+        ty = int(rx * self.touch_sy + self.touch_by)
+        return max(0, min(self.w - 1, tx)), max(0, min(self.h - 1, ty))
 
     def video_worker(self):
         """Ultra-optimized worker using OpenCV native drawing."""
-        # Use TCP to prevent 'overread' errors and stabilize stream
-        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
+        pin_thread(VIDEO_CORES, VIDEO_PRIORITY)
+        # OpenCV's resize/cvtColor pool inherits this affinity: one thread per
+        # video core splits work across them without oversubscribing one
+        cv2.setNumThreads(len(VIDEO_CORES))
+        # Use TCP to prevent 'overread' errors and stabilize stream; the rest
+        # stops FFmpeg holding frames in its input, jitter and reorder buffers
+        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = (
+            "rtsp_transport;tcp"
+            "|fflags;nobuffer|flags;low_delay|max_delay;0|reorder_queue_size;0"
+            "|probesize;32768|analyzeduration;500000"
+        )
 
         while self.running:
             cam = self.cameras[self.current_idx]
-            cap = cv2.VideoCapture(cam["url"], cv2.CAP_FFMPEG)
-            cap.set(cv2.CAP_PROP_BUFFERSIZE, 2)
+            ui_regions = self.ui_assets[cam["name"]]
+            raw = None  # CPU decodes land here, reused frame to frame
+            self.stale.reset()
+            cap = open_capture(cam["url"], (self.w, self.h))
 
             print(f"Streaming: {cam['name']}")
 
             while self.running and self.cameras[self.current_idx] == cam:
-                ret, img = cap.read()
+                if not cap.grab():
+                    break
+                # Only decode once the main loop has taken the last frame;
+                # the buffer it is showing stays untouched meanwhile
+                if not self.need_frame.wait(timeout=FRAME_TIME):
+                    continue
+                # Skip anything that queued up meanwhile, then decode once
+                if not self.stale.drain(cap):
+                    break
+                ret, img = cap.retrieve(raw)
                 if not ret:
                     break
+                raw = img  # OpenCV decodes into it again if the size still fits
+                self.need_frame.clear()
+
+                # 1. Get a screen-sized BGR frame we may draw on; the UI is
+                # stored in BGR too, so no colour conversion is needed
+                if isinstance(cap, HWCapture):
+                    # FFmpeg already scaled it; frames are read-only, so
+                    # take one copy to draw the UI on
+                    np.copyto(self.full_bgr, img)
+                    img = self.full_bgr
+                elif (img.shape[1], img.shape[0]) != (self.w, self.h):
+                    # Faster Resize (INTER_NEAREST is much lighter than default)
+                    cv2.resize(
+                        img,
+                        (self.w, self.h),
+                        dst=self.full_bgr,
+                        interpolation=cv2.INTER_NEAREST,
+                    )
+                    img = self.full_bgr
+                # Otherwise retrieve() decoded into our own array; draw on it as is
+
+                # 2. Blend the pre-rendered UI into its regions only
+                for reg in ui_regions:
+                    roi = img[reg["y1"] : reg["y2"], reg["x1"] : reg["x2"]]
+                    # Integer blending: (src * (255-alpha) + overlay * alpha) / 255,
+                    # rounded exactly as (x + (x >> 8)) >> 8 with x offset by 128.
+                    # Runs in the region's own uint16 scratch; nothing is allocated
+                    acc, tmp = reg["acc"], reg["tmp"]
+                    np.multiply(roi, reg["inv_alpha"], out=acc)
+                    np.add(acc, reg["overlay"], out=acc)
+                    np.right_shift(acc, 8, out=tmp)
+                    np.add(acc, tmp, out=acc)
+                    np.right_shift(acc, 8, out=acc)
+                    # Only write covered pixels; transparent ones stay untouched
+                    np.copyto(roi, acc, casting="unsafe", where=reg["where"])
 
-                # 1. Faster Resize (INTER_NEAREST is much lighter than default)
-                img = cv2.resize(img, (self.w, self.h), interpolation=cv2.INTER_NEAREST)
-
-                # 2. Draw UI using OpenCV (BGR Colors)
-                # Left Arrow
-                pts_l = np.array(
-                    [[10, self.h // 2], [30, self.h // 2 - 20], [30, self.h // 2 + 20]],
-                    np.int32,
-                )
-                cv2.fillPoly(img, [pts_l], (255, 255, 255))
-
-                # Right Arrow
-                pts_r = np.array(
-                    [
-                        [self.w - 10, self.h // 2],
-                        [self.w - 30, self.h // 2 - 20],
-                        [self.w - 30, self.h // 2 + 20],
-                    ],
-                    np.int32,
-                )
-                cv2.fillPoly(img, [pts_r], (255, 255, 255))
-
-                # Top Label (Black box + Text)
-                # cv2.rectangle(img, (self.w//2 - 60, 5), (self.w//2 + 60, 30), (0, 0, 0), -1)
-                cv2.putText(
-                    img,
-                    cam["name"],
-                    (self.w // 2 - 45, 22),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.5,
-                    (0, 255, 255),
-                    1,
-                    cv2.LINE_AA,
-                )
-
-                # 3. Final conversion to RGB and PIL (Only once per frame)
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                self.frame = Image.fromarray(img_rgb)
+                # 3. Convert straight into the framebuffer (RGB565 on the
+                # SPI panel) in one pass. cvtColor cuts the rows into one
+                # strip per 64K pixels (two for a 480x320 panel) and runs
+                # them on the setNumThreads(len(VIDEO_CORES)) pool above.
+                if self.fb_code is None:
+                    np.copyto(self.fb_view, img)
+                else:
+                    cv2.cvtColor(img, self.fb_code, dst=self.fb_view)
 
             cap.release()
             time.sleep(0.5)
 
     def touch_worker(self):
+        pin_thread(TOUCH_CORES)
         dev_path = self.find_touch_device()
         if not dev_path:
             return
         try:
             touch_hw = InputDevice(dev_path)
+            try:
+                touch_hw.grab()  # Sole reader; keeps taps from reaching the console
+            except OSError:
+                pass
+            # Block in the kernel until the controller fires, then drain in one go
+            poller = select.epoll()
+            poller.register(touch_hw.fd, select.EPOLLIN)
             raw_x, raw_y = 0, 0
-            for event in touch_hw.read_loop():
-                if event.type == ecodes.EV_ABS:
-                    if event.code == ecodes.ABS_X:
-                        raw_x = event.value
-                    if event.code == ecodes.ABS_Y:
-                        raw_y = event.value
-                elif event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
-                    if event.value == 0:
-                        px, py = self.map_coordinates(raw_x, raw_y)
-                        if px < self.btn_width:
-                            self.current_idx = (self.current_idx - 1) % len(
-                                self.cameras
-                            )
-                        elif px > (self.w - self.btn_width):
-                            self.current_idx = (self.current_idx + 1) % len(
-                                self.cameras
-                            )
-                        self.last_interaction_time = time.time()
+            released = False
+            while self.running:
+                poller.poll()
+                for event in touch_hw.read():
+                    if event.type == ecodes.EV_ABS:
+                        if event.code == ecodes.ABS_X:
+                            raw_x = event.value
+                        if event.code == ecodes.ABS_Y:
+                            raw_y = event.value
+                    elif event.type == ecodes.EV_KEY and event.code == ecodes.BTN_TOUCH:
+                        if event.value == 0:
+                            released = True
+                    elif (
+                        event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT
+                    ):
+                        # Act on a release only once its report is complete, so the
+                        # coordinates sent alongside it are already in
+                        if released:
+                            released = False
+                            px, py = self.map_coordinates(raw_x, raw_y)
+                            if px < self.left_xmax:
+                                self.current_idx = (self.current_idx - 1) % len(
+                                    self.cameras
+                                )
+                            elif px > self.right_xmin:
+                                self.current_idx = (self.current_idx + 1) % len(
+                                    self.cameras
+                                )
+                            self.next_cycle_at = time.monotonic() + AUTO_CYCLE_SECONDS
         except:
             pass
 
     def start(self):
-        threading.Thread(target=self.video_worker, daemon=True).start()
+        # systemd stops the service with SIGTERM; raise SystemExit on it so
+        # the cleanup below still runs and blanks the screen
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.video_thread = threading.Thread(target=self.video_worker, daemon=True)
+        self.video_thread.start()
         threading.Thread(target=self.touch_worker, daemon=True).start()
+        pin_thread(RENDER_CORES)
 
         try:
             while self.running:
-                start_loop = time.time()
+                now = time.monotonic()
 
                 # Auto-cycle check
-                if time.time() - self.last_interaction_time > AUTO_CYCLE_SECONDS:
+                if now >= self.next_cycle_at:
                     self.current_idx = (self.current_idx + 1) % len(self.cameras)
-                    self.last_interaction_time = time.time()
+                    self.next_cycle_at = now + AUTO_CYCLE_SECONDS
 
-                if self.frame is not None:
-                    self.device.display(self.frame)
+                # Let the worker put up the next frame
+                self.need_frame.set()
 
                 # FPS Governor: sleep just enough to maintain TARGET_FPS
-                loop_time = time.time() - start_loop
+                loop_time = time.monotonic() - now
                 time.sleep(max(0, FRAME_TIME - loop_time))
 
         except (KeyboardInterrupt, SystemExit):
             self.running = False
         finally:
             print("Cleaning up...")
+            # Stop the worker before blanking, or its next frame lands on
+            # top; a blocked grab gives up after OPEN_TIMEOUT_MS
+            self.running = False
+            self.need_frame.clear()
+            self.video_thread.join(timeout=OPEN_TIMEOUT_MS / 1000 + 1)
             try:
-                black = Image.new("RGB", (self.w, self.h), (0, 0, 0))
-                self.device.display(black)
+                self.fb_view[:] = 0  # Blank the panel
             except:
                 pass
             sys.exit(0)
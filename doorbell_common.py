@@ -0,0 +1,248 @@
+"""Capture, scheduling and framebuffer helpers shared by the doorbell viewers."""
+
+import cv2
+import time
+import os
+import glob
+import re
+import fcntl
+import struct
+import subprocess
+from functools import lru_cache
+
+try:
+    import ffmpegcv  # Optional: hardware H.264 decode (pip install ffmpegcv)
+except ImportError:
+    ffmpegcv = None
+
+MAX_STALE_GRABS = 5  # Frames skipped at most to catch up with the stream
+OPEN_TIMEOUT_MS = 5000  # Give up on a dead or stalled camera after this long
+
+# linux/fb.h ioctls for the screen geometry and row stride
+FBIOGET_VSCREENINFO = 0x4600
+FBIOGET_FSCREENINFO = 0x4602
+
+# --- GSTREAMER ---
+# Second choice after ffmpegcv: OpenCV builds with GStreamer can decode on
+# the Pi's V4L2 M2M block too, and v4l2convert scales and converts on the ISP
+# so frames arrive screen-sized. appsink keeps only the newest frame.
+HAVE_GSTREAMER = bool(re.search(r"GStreamer:\s*YES", cv2.getBuildInformation()))
+GST_PIPELINE = (
+    'rtspsrc location="{url}" protocols=tcp latency=50 tcp-timeout={timeout}'
+    " ! rtph264depay ! h264parse ! v4l2h264dec ! v4l2convert"
+    " ! video/x-raw,format=BGR,width={w},height={h}"
+    " ! appsink drop=1 max-buffers=1 sync=false"
+)
+
+
+def pin_thread(cores, fifo_priority=None):
+    """Pin the calling thread to cores and optionally make it SCHED_FIFO.
+
+    Best effort: skipped on CPUs without those cores or without permission.
+    """
+    try:
+        if cores <= os.sched_getaffinity(0):
+            os.sched_setaffinity(0, cores)
+    except (AttributeError, OSError):
+        pass
+    if fifo_priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(fifo_priority))
+        except (AttributeError, OSError):
+            pass
+
+
+def input_device_names():
+    """Yield (path, name) for every evdev node, read from sysfs like udev does.
+
+    Much cheaper than opening each device just to ask for its name.
+    """
+    for name_file in sorted(glob.glob("/sys/class/input/event*/device/name")):
+        event = name_file.split("/")[4]
+        try:
+            with open(name_file, "r") as f:
+                yield "/dev/input/" + event, f.read().strip()
+        except OSError:
+            continue
+
+
+def get_fb_geometry(fb, default):
+    """Return (width, height, bpp, stride, red_first) from the fb driver.
+
+    red_first is True when red sits in the lowest bits (RGB byte order),
+    so BGR frames need their channels swapped on the way out. If the ioctls
+    fail, sysfs is tried and then default, a (width, height, bpp) tuple.
+    """
+    try:
+        var = bytearray(160)  # struct fb_var_screeninfo
+        fcntl.ioctl(fb.fileno(), FBIOGET_VSCREENINFO, var)
+        w, h = struct.unpack_from("2I", var, 0)
+        bpp = struct.unpack_from("I", var, 24)[0]
+        red_offset = struct.unpack_from("I", var, 32)[0]  # red.offset
+
+        fix = bytearray(128)  # struct fb_fix_screeninfo
+        fcntl.ioctl(fb.fileno(), FBIOGET_FSCREENINFO, fix)
+        stride = struct.unpack_from("16sL4I3HI", fix)[-1]  # line_length
+        return w, h, bpp, stride, red_offset == 0
+    except OSError:
+        # Fall back to sysfs and assume unpadded rows
+        sysfs = "/sys/class/graphics/" + os.path.basename(fb.name)
+        try:
+            with open(sysfs + "/virtual_size", "r") as f:
+                w, h = (int(v) for v in f.read().strip().split(","))
+            with open(sysfs + "/bits_per_pixel", "r") as f:
+                bpp = int(f.read().strip())
+        except:
+            w, h, bpp = default
+        return w, h, bpp, w * (bpp // 8), False
+
+
+@lru_cache(maxsize=None)
+def rtsp_timeout_flag():
+    """FFmpeg flag for the RTSP socket timeout, which version 5 renamed.
+
+    On 4.x (Bullseye) -timeout is a listen timeout that puts RTSP into
+    server mode, so the old -stimeout is needed there.
+    """
+    try:
+        out = subprocess.run(
+            ["ffmpeg", "-version"], capture_output=True, text=True, timeout=5
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        out = ""
+    m = re.match(r"ffmpeg version \D*(\d+)\.", out)
+    # Git snapshots report no release number; treat them as current
+    return "-stimeout" if m and int(m.group(1)) < 5 else "-timeout"
+
+
+class HWDecodeError(RuntimeError):
+    """The stream opened but the hardware decoder produced no frame."""
+
+
+class HWCapture:
+    """cv2.VideoCapture look-alike backed by ffmpegcv and the Pi's V4L2 M2M decoder.
+
+    Frames arrive already scaled to ``size`` so the CPU never touches H.264.
+    """
+
+    def __init__(self, url, size, pix_fmt="bgr24"):
+        infile_options = None
+        if url.startswith("rtsp://"):
+            infile_options = f"{rtsp_timeout_flag()} {OPEN_TIMEOUT_MS * 1000}"
+        # ReadLiveLast keeps only the newest frame, hiding RTSP jitter
+        self.vid = ffmpegcv.ReadLiveLast(
+            ffmpegcv.VideoCaptureStreamRT,
+            url,
+            codec="h264_v4l2m2m",
+            resize=size,
+            resize_keepratio=False,
+            pix_fmt=pix_fmt,
+            # Bound the probe and every socket read, so a stalled camera
+            # ends the stream (and the reader's wait) instead of hanging it
+            timeout=OPEN_TIMEOUT_MS / 1000,
+            infile_options=infile_options,
+        )
+        # ffmpegcv only runs ffprobe up front; FFmpeg itself starts on the
+        # first read, so pull one frame now to know the decoder really works
+        ret, self.img = self.read()
+        if not ret:
+            self.release()
+            raise HWDecodeError("h264_v4l2m2m produced no frame")
+
+    def isOpened(self):
+        return True  # Construction raises on any failure instead
+
+    def set(self, prop, value):
+        return False
+
+    def read(self):
+        ret, img = self.vid.read()
+        return ret and img is not None, img
+
+    def grab(self):
+        ret, self.img = self.read()
+        return ret
+
+    def retrieve(self, image=None):
+        return self.img is not None, self.img
+
+    def release(self):
+        self.vid.release()
+
+
+# Cameras whose stream the hardware decoder could not handle; they go
+# straight to the next tier on every reconnect
+_hw_failed_urls = set()
+
+
+def open_capture(url, size, hw_pix_fmt="bgr24"):
+    """Open a camera stream, preferring the hardware decoder."""
+    if ffmpegcv is not None and url not in _hw_failed_urls:
+        try:
+            return HWCapture(url, size, hw_pix_fmt)
+        except HWDecodeError as e:
+            _hw_failed_urls.add(url)
+            print(f"ffmpegcv hardware decode failed, not retrying it: {e}")
+        except Exception as e:
+            print(f"ffmpegcv hardware decode unavailable: {e}")
+    if HAVE_GSTREAMER:
+        # Quoted, so query strings with ! or spaces stay one property value
+        quoted = url.replace("\\", "\\\\").replace('"', '\\"')
+        pipeline = GST_PIPELINE.format(
+            url=quoted, w=size[0], h=size[1], timeout=OPEN_TIMEOUT_MS * 1000
+        )
+        cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+        if cap.isOpened():
+            return cap
+        print("GStreamer hardware decode unavailable, using CPU")
+    # Bound the connect and read calls too, so a dead camera cannot hang
+    # the worker inside FFmpeg
+    cap = cv2.VideoCapture(
+        url,
+        cv2.CAP_FFMPEG,
+        [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC,
+            OPEN_TIMEOUT_MS,
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC,
+            OPEN_TIMEOUT_MS,
+        ],
+    )
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return cap
+
+
+class StaleFrameSkipper:
+    """Grabs past frames that queued up while the renderer was busy.
+
+    Uses the stream clock to tell when we have caught up, so only the
+    newest frame gets retrieved.
+    """
+
+    def __init__(self, frame_time):
+        self.frame_time = frame_time
+        self.reset()
+
+    def reset(self):
+        """Forget the stream clock; call whenever a new stream is opened."""
+        self.base_lag = None  # Smallest wall-clock minus stream-clock lag seen
+
+    def drain(self, cap):
+        """Skip stale frames on cap. Returns False if the stream dropped."""
+        if isinstance(cap, HWCapture):
+            return True  # ReadLiveLast already hands out the newest frame
+        for _ in range(MAX_STALE_GRABS):
+            pos = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if pos <= 0:
+                return True  # No usable timestamps on this stream
+            lag = time.monotonic() - pos
+            if self.base_lag is None or lag < self.base_lag:
+                self.base_lag = lag
+            if lag - self.base_lag < self.frame_time:
+                return True
+            if not cap.grab():
+                return False
+        # Still behind after every grab: the camera clock has drifted from
+        # ours, so take the current lag as the new baseline next time
+        # instead of grabbing the maximum on every frame from now on
+        self.reset()
+        return True
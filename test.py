@@ -4,6 +4,20 @@ import os
 # Tell Pygame to use the framebuffer
 os.putenv('SDL_FBDEV', '/dev/fb0')
 
+# Try each video driver in turn and keep the first one that comes up
+# (None lets SDL pick its default)
+for driver in ('kmsdrm', 'fbcon', None):
+    if driver:
+        os.environ['SDL_VIDEODRIVER'] = driver
+    else:
+        os.environ.pop('SDL_VIDEODRIVER', None)
+    try:
+        pygame.display.init()
+        print(f'Using SDL video driver: {pygame.display.get_driver()}')
+        break
+    except pygame.error:
+        pygame.display.quit()
+
 pygame.init()
 
 # Get screen size